@@ -1,22 +1,47 @@
-from flask import Flask, request
+from quart import Quart, request
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
+from twilio.base.exceptions import TwilioRestException
+from twilio.request_validator import RequestValidator
+import asyncio
 import os
+import re
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, but it also has no multi-worker deployment here
+    fcntl = None
 import sqlite3
+import threading
+import queue
+import time
+import atexit
+from itertools import groupby
 from dotenv import load_dotenv
 from datetime import datetime
 import logging
-import requests # ADDED: Import the requests library for API calls
+import logging.handlers
+import httpx
+from cachetools import TTLCache
 import json # ADDED: Import json for handling API responses
-
-# Configure basic logging for Flask app
-logging.basicConfig(level=logging.INFO)
+import orjson
+import zstandard
 
 # --- Explicitly load environment variables from .env file in the script's directory ---
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 
-app = Flask(__name__)
+# Configure logging for Quart app. Request handlers only enqueue records; a listener
+# thread does the (locking, blocking) writes to stderr.
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+                    handlers=[logging.handlers.QueueHandler(_log_queue)])
+# httpx logs every request at INFO; keep that per-message noise out of the default output
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+app = Quart(__name__)
 
 # --- IMPORTANT: Use environment variables for sensitive data ---
 try:
@@ -30,112 +55,330 @@ except ValueError as e:
     app.logger.error("Please ensure TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN are set in your .env file.")
     client = None
 
+# Sender for replies delivered outside the webhook response (defaults to the Twilio Sandbox number)
+TWILIO_SANDBOX_FROM = 'whatsapp:+14155238886'
+TWILIO_WHATSAPP_FROM = os.getenv('TWILIO_WHATSAPP_FROM', TWILIO_SANDBOX_FROM)
+if 'TWILIO_WHATSAPP_FROM' not in os.environ:
+    app.logger.warning(f"⚠️ TWILIO_WHATSAPP_FROM is not set; diagnoses will be sent from the Twilio Sandbox number {TWILIO_SANDBOX_FROM}.")
+
+# Webhook requests are checked against X-Twilio-Signature before any DB or Gemini work.
+# The signature covers the public URL Twilio called; behind a TLS-terminating proxy
+# (e.g. Render) set TWILIO_WEBHOOK_URL to it, since request.url would say http://.
+# Without TWILIO_AUTH_TOKEN every webhook request is rejected; unsigned local testing
+# needs the explicit TWILIO_SKIP_SIGNATURE_CHECK=1 opt-out.
+TWILIO_WEBHOOK_URL = os.getenv('TWILIO_WEBHOOK_URL')
+TWILIO_SKIP_SIGNATURE_CHECK = os.getenv('TWILIO_SKIP_SIGNATURE_CHECK') == '1'
+_validator = RequestValidator(TWILIO_AUTH_TOKEN) if TWILIO_AUTH_TOKEN else None
+if TWILIO_SKIP_SIGNATURE_CHECK:
+    app.logger.warning("⚠️ TWILIO_SKIP_SIGNATURE_CHECK is set; webhook signatures will not be checked.")
+elif _validator is None:
+    app.logger.error("❌ TWILIO_AUTH_TOKEN is not set; all webhook requests will be rejected.")
+
 # --- Database setup ---
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'medical.db')
 
+_tls = threading.local()
+
+def get_conn():
+    """
+    Returns this thread's connection to the consultations database, opening it
+    with the per-connection PRAGMAs applied on first use. journal_mode=WAL is
+    persisted in the file itself, but the remaining settings only last for the
+    lifetime of a connection, so reusing it avoids re-issuing them per message.
+
+    The connection runs in autocommit mode; callers that need a transaction
+    issue BEGIN IMMEDIATE / COMMIT themselves.
+    """
+    conn = getattr(_tls, 'conn', None)
+    if conn is not None:
+        return conn
+
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, isolation_level=None)
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;  -- WAL is still crash-safe; skips one fsync per commit
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-8000;  -- ~8 MB page cache
+        PRAGMA mmap_size=268435456;  -- 256 MB
+    ''')
+    _tls.conn = conn
+    return conn
+
+# Last three consultations for a phone number, newest first
+HISTORY_QUERY = '''SELECT symptoms, diagnosis_name, timestamp, patient_name
+                   FROM consultations
+                   WHERE phone = ?
+                   ORDER BY timestamp DESC
+                   LIMIT 3'''
+
+# Disclaimer wrapped around every Gemini diagnosis when it is sent (see format_report)
+DISCLAIMER_HEAD = "⚠️ Disclaimer: I am an AI and cannot provide medical advice. Consult a doctor for health concerns.\n\n"
+DISCLAIMER_TAIL = "\n\nRemember to consult a healthcare professional for diagnosis and treatment."
+
+# Tables and indexes, created in one transaction by init_db() after any column migrations
+_SCHEMA_SQL = '''
+    BEGIN IMMEDIATE;
+
+    CREATE TABLE IF NOT EXISTS consultations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone TEXT NOT NULL,
+        symptoms TEXT NOT NULL,
+        diagnosis_name TEXT,
+        diagnosis_body TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        patient_name TEXT
+    );
+
+    -- Covering index for HISTORY_QUERY: the lookup is answered from index pages alone.
+    -- It supersedes the narrower (phone, timestamp) index from earlier releases.
+    DROP INDEX IF EXISTS idx_consultations_phone_ts;
+    CREATE INDEX IF NOT EXISTS idx_hist
+    ON consultations (phone, timestamp DESC, symptoms, diagnosis_name, patient_name);
+
+    -- Lets _archive_old_rows find and delete rows past the cutoff without a full table scan
+    CREATE INDEX IF NOT EXISTS idx_consultations_ts ON consultations (timestamp);
+
+    -- Cold consultations, packed per phone (see _archive_old_rows)
+    CREATE TABLE IF NOT EXISTS consultations_archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone TEXT NOT NULL,
+        packed BLOB NOT NULL,
+        row_count INTEGER NOT NULL,
+        from_ts DATETIME NOT NULL,
+        to_ts DATETIME NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_archive_phone_ts
+    ON consultations_archive (phone, from_ts);
+
+    COMMIT;
+'''
+
 def init_db():
     """
     Initializes the SQLite database, creating the consultations table
-    with all necessary columns. It forces a recreation of the database
-    file on each startup to ensure a clean schema.
+    and its history index if they do not exist yet. Existing data is kept
+    across restarts; columns added after the first release are migrated in.
+    Raises sqlite3.Error if the schema can't be set up, since every later
+    read and write would fail.
     """
     try:
-        # This is aggressive and means data will be lost on every deploy/restart.
-        # For production, you'd use a persistent external database like PostgreSQL.
-        if os.path.exists(DATABASE_PATH):
-            os.remove(DATABASE_PATH)
-            app.logger.info(f"🗑️ Deleted existing database file: {DATABASE_PATH}")
-
-        with sqlite3.connect(DATABASE_PATH) as conn:
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                CREATE TABLE consultations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    phone TEXT NOT NULL,
-                    symptoms TEXT NOT NULL,
-                    diagnosis TEXT,
-                    response TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    patient_name TEXT DEFAULT 'Unknown'
-                )
-            ''')
-            app.logger.info("✅ 'consultations' table created.")
+        conn = get_conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(consultations)").fetchall()}
+
+            # Older databases were created without patient_name
+            if columns and 'patient_name' not in columns:
+                conn.execute("ALTER TABLE consultations ADD COLUMN patient_name TEXT DEFAULT 'Unknown'")
+                app.logger.info("✅ Added 'patient_name' column to 'consultations'.")
+
+            # Older databases stored the full outbound report in `response`; keep only the
+            # diagnosis text, since the report template is rebuilt from symptoms + diagnosis
+            if 'diagnosis' in columns:
+                conn.execute("ALTER TABLE consultations RENAME COLUMN diagnosis TO diagnosis_name")
+                conn.execute("ALTER TABLE consultations RENAME COLUMN response TO diagnosis_body")
+                conn.execute('''UPDATE consultations
+                                SET diagnosis_body = CASE
+                                    WHEN diagnosis_name IS NULL THEN NULL
+                                    ELSE substr(diagnosis_body, length('AI Doctor Report:' || char(10, 10) ||
+                                                'Symptoms: ' || symptoms || char(10) || 'Diagnosis: ') + 1)
+                                END''')
+                conn.execute("UPDATE consultations SET patient_name = NULL WHERE patient_name = 'Unknown'")
+                app.logger.info("✅ Migrated 'consultations' to diagnosis_name/diagnosis_body columns.")
 
-            conn.commit()
-            app.logger.info("✅ Database initialization complete.")
+            # The earliest databases had `response` but no `diagnosis` column. Their responses
+            # don't use the report template, so they are kept whole as the diagnosis text.
+            elif 'response' in columns:
+                conn.execute("ALTER TABLE consultations ADD COLUMN diagnosis_name TEXT")
+                conn.execute("ALTER TABLE consultations RENAME COLUMN response TO diagnosis_body")
+                conn.execute("UPDATE consultations SET patient_name = NULL WHERE patient_name = 'Unknown'")
+                app.logger.info("✅ Migrated legacy 'consultations' to diagnosis_name/diagnosis_body columns.")
+
+            # Data migrations, tracked in user_version so they run once per database
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if columns and version < 1:
+                # Gemini diagnoses used to be stored with the disclaimer around them
+                conn.execute('''UPDATE consultations
+                                SET diagnosis_body = substr(diagnosis_body, length(:head) + 1,
+                                                            length(diagnosis_body) - length(:head) - length(:tail))
+                                WHERE diagnosis_name = 'LLM Diagnosis'
+                                  AND substr(diagnosis_body, 1, length(:head)) = :head
+                                  AND substr(diagnosis_body, -length(:tail)) = :tail''',
+                             {'head': DISCLAIMER_HEAD, 'tail': DISCLAIMER_TAIL})
+                app.logger.info("✅ Stripped the disclaimer from stored diagnoses.")
+            conn.execute("PRAGMA user_version = 1")
+            conn.execute("COMMIT")
+
+            conn.executescript(_SCHEMA_SQL)
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        app.logger.info("✅ Database initialization complete.")
+
+        if os.getenv('EXPLAIN_HISTORY_QUERY'):
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {HISTORY_QUERY}", ('',)).fetchall()
+            app.logger.info(f"History query plan: {[row[-1] for row in plan]}")
     except sqlite3.Error as e:
         app.logger.error(f"❌ Database initialization failed: {e}", exc_info=True)
+        raise
 
-# Initialize database on app startup
-init_db()
+# Initialize database on app startup. Every hypercorn worker imports this module,
+# so the file lock keeps them from running the schema setup at the same time.
+# Without fcntl (Windows, local development) there is a single process, so no lock is needed.
+if fcntl is None:
+    init_db()
+else:
+    with open(f"{DATABASE_PATH}.lock", "w") as _init_lock:
+        fcntl.flock(_init_lock, fcntl.LOCK_EX)
+        try:
+            init_db()
+        finally:
+            fcntl.flock(_init_lock, fcntl.LOCK_UN)
 
 # --- Gemini API Integration ---
 # The API key will be injected by the Canvas environment
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '') # Empty string for Canvas injection
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+# The key travels in the x-goog-api-key header (see _HEADERS), not the URL, so it never
+# shows up in request logs or HTTP error messages
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+
+# The instructions never change, so they are sent as a fixed leading part of the prompt
+# (a stable prefix is what Gemini's implicit prompt caching keys on)
+_PROMPT_PREFIX = (
+    "You are an AI assistant designed to provide general information about symptoms.\n"
+    "You are NOT a medical doctor and cannot give medical advice.\n"
+    "Always include a clear disclaimer at the beginning and end of your response stating this.\n\n"
+    "Based on the following symptoms, provide a brief, general explanation of what they might indicate,\n"
+    "and suggest common next steps (e.g., rest, hydration, or when to see a doctor).\n"
+    "Keep the response concise and suitable for a WhatsApp message (under 160 characters if possible, but prioritize clarity).\n\n"
+    "Symptoms: "
+)
+_GEN_CFG = {
+    "temperature": 0.7,
+    "topP": 0.95,
+    "topK": 40,
+    "maxOutputTokens": 200 # Limit output length for WhatsApp
+}
+_HEADERS = {'Content-Type': 'application/json', 'x-goog-api-key': GEMINI_API_KEY}
+
+# Shared HTTP/2 client: concurrent diagnoses are multiplexed over one TLS connection to Gemini.
+# It is bound to the serving event loop, so it is opened and closed with the app.
+_gemini = None
+
+@app.before_serving
+async def _open_gemini_client():
+    global _gemini
+    _gemini = httpx.AsyncClient(
+        timeout=httpx.Timeout(20.0, connect=3.0),
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            retries=2,  # retries failed connects only
+        ),
+    )
+
+@app.after_serving
+async def _close_gemini_client():
+    await _gemini.aclose()
+
+# --- Input screening ---
+# Messages that are too short or plainly noise (no letters in any script, or one character
+# repeated) are answered by the webhook itself, before any background diagnosis is queued;
+# overly long ones are truncated by diagnose(). Anything else, in any language, goes to the model.
+MIN_SYMPTOMS_LEN = 3
+MAX_SYMPTOMS_LEN = 500
+
+def _is_noise(symptoms):
+    """True for messages with no letters at all or a single repeated character"""
+    if not any(ch.isalpha() for ch in symptoms):
+        return True
+    return len(set(symptoms.casefold().replace(" ", ""))) == 1
+
+def _screen_symptoms(symptoms):
+    """Returns the reply for a message that should not be diagnosed, or None"""
+    symptoms = symptoms.strip()
+    if len(symptoms) < MIN_SYMPTOMS_LEN:
+        return "Please describe your symptoms in a bit more detail (e.g. 'headache and fever')."
+    if _is_noise(symptoms):
+        return "I couldn't find any symptoms in that message. Please describe how you feel (e.g. 'headache and fever')."
+    return None
+
+# --- Diagnosis cache ---
+# Messages that differ only in case, spacing or punctuation ("Fever, headache" / "fever headache")
+# share one Gemini answer. Word order is kept, so "fever but no cough" and "cough but no fever"
+# stay distinct.
+_diagnosis_cache = TTLCache(maxsize=4096, ttl=3600)
+_diagnosis_cache_lock = threading.Lock()
+
+# ASCII punctuation and whitespace only: \W would also strip combining marks such as
+# Devanagari vowel signs and merge different words
+_KEY_SEPARATORS_RE = re.compile(r"[\s!-/:-@\[-`{-~]+")
 
-def diagnose(symptoms):
+def _normalize_symptoms(symptoms):
+    """Canonical cache key: casefolded text with punctuation and whitespace collapsed"""
+    return _KEY_SEPARATORS_RE.sub(" ", symptoms.casefold()).strip()
+
+async def diagnose(symptoms):
     """
-    Diagnoses symptoms using the Gemini LLM.
-    Provides a disclaimer that it's not medical advice.
+    Returns a (diagnosis_name, response) pair for the symptoms, answering
+    repeated symptom descriptions from the cache. Errors are never cached.
+    Callers screen the message with _screen_symptoms() first.
     """
-    app.logger.info(f"Calling Gemini API for diagnosis with symptoms: '{symptoms}'")
+    symptoms = symptoms.strip()[:MAX_SYMPTOMS_LEN]
 
-    prompt = f"""
-    You are an AI assistant designed to provide general information about symptoms.
-    You are NOT a medical doctor and cannot give medical advice.
-    Always include a clear disclaimer at the beginning and end of your response stating this.
+    key = _normalize_symptoms(symptoms)
+    if key:
+        with _diagnosis_cache_lock:
+            cached = _diagnosis_cache.get(key)
+        if cached is not None:
+            app.logger.debug(f"Diagnosis cache hit for symptoms: '{symptoms}'")
+            return cached
 
-    Based on the following symptoms, provide a brief, general explanation of what they might indicate,
-    and suggest common next steps (e.g., rest, hydration, or when to see a doctor).
-    Keep the response concise and suitable for a WhatsApp message (under 160 characters if possible, but prioritize clarity).
+    result = await _diagnose_llm(symptoms)
+    if key and result[0] != "LLM Error":
+        with _diagnosis_cache_lock:
+            _diagnosis_cache[key] = result
+    return result
 
-    Symptoms: {symptoms}
+async def _diagnose_llm(symptoms):
     """
+    Diagnoses symptoms using the Gemini LLM.
+    Provides a disclaimer that it's not medical advice.
+    """
+    app.logger.debug(f"Calling Gemini API for diagnosis with symptoms: '{symptoms}'")
 
-    headers = {'Content-Type': 'application/json'}
     payload = {
-        "contents": [{"role": "user", "parts": [{"text": prompt}]}],
-        "generationConfig": {
-            "temperature": 0.7,
-            "topP": 0.95,
-            "topK": 40,
-            "maxOutputTokens": 200 # Limit output length for WhatsApp
-        }
+        "contents": [{"role": "user", "parts": [{"text": _PROMPT_PREFIX}, {"text": symptoms}]}],
+        "generationConfig": _GEN_CFG,
     }
 
     try:
-        response = requests.post(GEMINI_API_URL, headers=headers, data=json.dumps(payload))
+        response = await _gemini.post(GEMINI_API_URL, content=orjson.dumps(payload), headers=_HEADERS)
         response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        result = response.json()
+        result = orjson.loads(response.content)
 
         if result and result.get('candidates') and result['candidates'][0].get('content') and result['candidates'][0]['content'].get('parts'):
             diagnosis_text = result['candidates'][0]['content']['parts'][0]['text']
-            # Add a clear disclaimer at the beginning of the response
-            final_response = (
-                "⚠️ Disclaimer: I am an AI and cannot provide medical advice. Consult a doctor for health concerns.\n\n"
-                f"{diagnosis_text}\n\n"
-                "Remember to consult a healthcare professional for diagnosis and treatment."
-            )
-            return "LLM Diagnosis", final_response
+            # The disclaimer is added by format_report() when the report is sent
+            return "LLM Diagnosis", diagnosis_text
         else:
             app.logger.error(f"Gemini API response structure unexpected: {result}")
             return "LLM Error", "⚠️ AI diagnosis unavailable. Please try again or consult a doctor."
 
-    except requests.exceptions.HTTPError as errh:
+    except httpx.HTTPStatusError as errh:
         app.logger.error(f"HTTP Error: {errh}", exc_info=True)
         return "LLM Error", "⚠️ AI diagnosis currently unavailable due to a network issue. Please try again later."
-    except requests.exceptions.ConnectionError as errc:
+    except httpx.ConnectError as errc:
         app.logger.error(f"Error Connecting: {errc}", exc_info=True)
         return "LLM Error", "⚠️ AI diagnosis currently unavailable due to a connection issue. Please try again later."
-    except requests.exceptions.Timeout as errt:
+    except httpx.TimeoutException as errt:
         app.logger.error(f"Timeout Error: {errt}", exc_info=True)
         return "LLM Error", "⚠️ AI diagnosis currently unavailable due to a timeout. Please try again later."
-    except requests.exceptions.RequestException as err:
+    except httpx.RequestError as err:
         app.logger.error(f"General Request Error: {err}", exc_info=True)
         return "LLM Error", "⚠️ AI diagnosis currently unavailable due to an unexpected error. Please try again later."
-    except json.JSONDecodeError as e:
+    except (json.JSONDecodeError, orjson.JSONDecodeError) as e:
         app.logger.error(f"JSON Decode Error: {e} - Response: {response.text}", exc_info=True)
         return "LLM Error", "⚠️ AI diagnosis unavailable due to a response formatting issue. Please try again."
     except Exception as e:
@@ -143,68 +386,212 @@ def diagnose(symptoms):
         return "LLM Error", "⚠️ An unexpected AI error occurred. Please try again."
 
 
-def save_to_db(phone, symptoms, diagnosis, response, patient_name="Unknown"):
-    """Safe database operation with context manager"""
+# --- Batched consultation writes ---
+# Webhook handlers only enqueue rows; a single writer thread drains the queue and
+# commits up to BATCH_MAX_ROWS rows per transaction, so one fsync covers many messages.
+BATCH_MAX_ROWS = 100
+BATCH_MAX_WAIT = 0.05  # seconds to wait for more rows after the first one arrives
+
+_pending = queue.Queue()
+_STOP = object()
+
+def _write_batch(items):
+    """Inserts a batch of consultation rows in one transaction"""
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany('''INSERT INTO consultations
+                            (phone, symptoms, diagnosis_name, diagnosis_body, patient_name)
+                            VALUES (?, ?, ?, ?, ?)''', items)
+        conn.execute("COMMIT")
+        app.logger.debug(f"💾 Saved {len(items)} consultation(s)")
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        app.logger.error(f"❌ Database Error during save, dropped {len(items)} consultation(s): {e}", exc_info=True)
+
+# --- Archiving ---
+# Consultations older than ARCHIVE_AFTER_DAYS leave the hot table. Each phone's rows are
+# packed into consultations_archive, up to ARCHIVE_PACK_ROWS rows per record, as zstd-compressed
+# JSON: a list of [symptoms, diagnosis_name, diagnosis_body, timestamp, patient_name].
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_PACK_ROWS = 500
+ARCHIVE_INTERVAL = 3600  # seconds between archive passes
+
+_zstd = zstandard.ZstdCompressor(level=3)  # only used from the writer thread
+_next_archive = 0.0  # time.monotonic() deadline for the next pass
+
+def _archive_old_rows():
+    """Moves consultations older than ARCHIVE_AFTER_DAYS into consultations_archive"""
+    conn = get_conn()
     try:
-        with sqlite3.connect(DATABASE_PATH) as conn:
-            conn.execute('''INSERT INTO consultations
-                            (phone, symptoms, diagnosis, response, patient_name)
-                            VALUES (?, ?, ?, ?, ?)''',
-                           (phone, symptoms, diagnosis, response, patient_name))
-            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
-            app.logger.info(f"💾 Saved consultation ID: {last_id}")
-            return True
+        conn.execute("BEGIN IMMEDIATE")
+        # 'now' is only stable within one statement, so the cutoff is fixed once and shared
+        # by the SELECT and the DELETE; otherwise rows could be deleted without being archived
+        cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{ARCHIVE_AFTER_DAYS} days",)).fetchone()[0]
+        rows = conn.execute('''SELECT phone, symptoms, diagnosis_name, diagnosis_body, timestamp, patient_name
+                              FROM consultations
+                              WHERE timestamp < ?
+                              ORDER BY timestamp''', (cutoff,)).fetchall()
+        rows.sort(key=lambda row: row[0])  # group by phone; the sort is stable, so timestamps stay ordered
+        packs = []
+        for phone, phone_rows in groupby(rows, key=lambda row: row[0]):
+            phone_rows = [list(row[1:]) for row in phone_rows]
+            for start in range(0, len(phone_rows), ARCHIVE_PACK_ROWS):
+                chunk = phone_rows[start:start + ARCHIVE_PACK_ROWS]
+                packs.append((phone, _zstd.compress(orjson.dumps(chunk)), len(chunk), chunk[0][3], chunk[-1][3]))
+        conn.executemany('''INSERT INTO consultations_archive
+                            (phone, packed, row_count, from_ts, to_ts)
+                            VALUES (?, ?, ?, ?, ?)''', packs)
+        conn.execute("DELETE FROM consultations WHERE timestamp < ?", (cutoff,))
+        conn.execute("COMMIT")
+        if rows:
+            app.logger.info(f"🗄️ Archived {len(rows)} consultation(s) into {len(packs)} packed row(s)")
     except sqlite3.Error as e:
-        app.logger.error(f"❌ Database Error during save: {e}", exc_info=True)
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        app.logger.error(f"❌ Database Error during archiving: {e}", exc_info=True)
+
+def _batch_writer():
+    """Drains the pending queue until it receives _STOP"""
+    global _next_archive
+    while True:
+        item = _pending.get()
+        if item is _STOP:
+            return
+        items = [item]
+        stop = False
+        deadline = time.monotonic() + BATCH_MAX_WAIT
+        while len(items) < BATCH_MAX_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            items.append(item)
+        _write_batch(items)
+        if time.monotonic() >= _next_archive:
+            _next_archive = time.monotonic() + ARCHIVE_INTERVAL
+            _archive_old_rows()
+        if stop:
+            return
+
+_writer = threading.Thread(target=_batch_writer, name="consultation-writer", daemon=True)
+_writer.start()
+
+@atexit.register
+def _flush_pending():
+    """Writes out anything still queued before the process exits"""
+    _pending.put(_STOP)
+    _writer.join(timeout=5)
+
+def format_report(symptoms, diagnosis_name, diagnosis_body):
+    """
+    Builds the outbound report text; only diagnosis_body is stored. Gemini
+    diagnoses are wrapped in the disclaimer, error messages are sent as-is.
+    """
+    if diagnosis_name == "LLM Diagnosis":
+        diagnosis_body = f"{DISCLAIMER_HEAD}{diagnosis_body}{DISCLAIMER_TAIL}"
+    return f"AI Doctor Report:\n\nSymptoms: {symptoms}\nDiagnosis: {diagnosis_body}"
+
+def save_to_db(phone, symptoms, diagnosis_name=None, diagnosis_body=None, patient_name=None):
+    """
+    Queues one consultation for the background writer. Returns False only if
+    the writer is no longer running, since the row would never be saved.
+    diagnosis_body is the diagnosis text alone, without the report template.
+    """
+    if not _writer.is_alive():
+        app.logger.error("❌ Consultation writer is not running; consultation not saved.")
         return False
+    _pending.put((phone, symptoms, diagnosis_name, diagnosis_body, patient_name))
+    return True
+
+async def _handle_diagnosis_async(phone, symptoms, patient_name):
+    """
+    Diagnoses symptoms, saves the consultation and sends the report over WhatsApp.
+    Runs as an app background task so the Twilio webhook is not held open.
+    """
+    try:
+        diagnosis_name, diagnosis_response = await diagnose(symptoms)
+        save_to_db(phone, symptoms, diagnosis_name, diagnosis_response, patient_name)
+        # The Twilio client is blocking, so the send runs on a worker thread
+        message = await asyncio.to_thread(client.messages.create, from_=TWILIO_WHATSAPP_FROM, to=phone,
+                                          body=format_report(symptoms, diagnosis_name, diagnosis_response))
+        app.logger.debug(f"📤 Sent diagnosis to {phone} (SID: {message.sid})")
+    except TwilioRestException as e:
+        app.logger.error(f"❌ Twilio Error while sending diagnosis: {e}", exc_info=True)
+    except Exception as e:
+        app.logger.error(f"❌ Unexpected error during background diagnosis: {e}", exc_info=True)
+
+# Keyword commands recognised in an incoming message
+_CMD_RE = re.compile(r"\b(hello|history)\b", re.IGNORECASE)
 
 @app.route("/whatsapp", methods=["POST"])
-def whatsapp_reply():
+async def whatsapp_reply():
     # Get incoming data
-    phone = request.values.get('From', '')
-    incoming_msg = request.values.get('Body', '').strip()
+    form = await request.form
+    if not TWILIO_SKIP_SIGNATURE_CHECK and (_validator is None or not _validator.validate(
+            TWILIO_WEBHOOK_URL or request.url, form, request.headers.get('X-Twilio-Signature', ''))):
+        app.logger.warning("🚫 Rejected webhook request with a missing or invalid Twilio signature.")
+        return "", 403
+
+    phone = form.get('From', '')
+    incoming_msg = form.get('Body', '').strip()
 
-    app.logger.info(f"\n=== INCOMING MESSAGE ===")
-    app.logger.info(f"From: {phone}")
-    app.logger.info(f"Content: '{incoming_msg}'")
+    app.logger.debug(f"\n=== INCOMING MESSAGE ===")
+    app.logger.debug(f"From: {phone}")
+    app.logger.debug(f"Content: '{incoming_msg}'")
 
     # Prepare response
     resp = MessagingResponse()
     response_text = ""
     diagnosis_name = None
+    diagnosis_response = None
+
+    # Determine patient_name (you might want to add a way for users to set this)
+    patient_name_for_save = None
+
+    command = _CMD_RE.search(incoming_msg) if incoming_msg else None
+    command = command.group(1).lower() if command else None
+    rejection = _screen_symptoms(incoming_msg) if incoming_msg and not command else None
 
     if not incoming_msg:
         response_text = "Please describe your symptoms (e.g., 'headache and fever')."
-    elif "hello" in incoming_msg.lower():
+    elif command == "hello":
         response_text = "👋 Hi! Describe your symptoms (e.g. 'headache and fever')"
-    elif "history" in incoming_msg.lower():
+    elif command == "history":
         # Feature: Retrieve last 3 consultations
         try:
-            with sqlite3.connect(DATABASE_PATH) as conn:
-                history = conn.execute('''SELECT symptoms, diagnosis, timestamp, patient_name
-                                         FROM consultations
-                                         WHERE phone = ?
-                                         ORDER BY timestamp DESC
-                                         LIMIT 3''', (phone,)).fetchall()
-                if history:
-                    response_text = "📜 Your History:\n" + "\n".join(
-                        f"[{row[2]}] {row[3]} - Symptoms: {row[0]} → Diagnosis: {row[1]}" for row in history
-                    )
-                else:
-                    response_text = "No history found for this number."
+            history = get_conn().execute(HISTORY_QUERY, (phone,)).fetchall()
+            if history:
+                response_text = "📜 Your History:\n" + "\n".join(
+                    f"[{row[2]}] {row[3] or 'Unknown'} - Symptoms: {row[0]} → Diagnosis: {row[1]}" for row in history
+                )
+            else:
+                response_text = "No history found for this number."
         except sqlite3.Error as e:
             response_text = "⚠️ Could not retrieve history due to a database error."
             app.logger.error(f"History retrieval Error: {e}", exc_info=True)
+    elif rejection is not None:
+        # Noise is answered here so it never costs a background task or an outbound message
+        response_text = rejection
+    elif client is not None:
+        # Acknowledge right away; the report follows as a separate message
+        app.add_background_task(_handle_diagnosis_async, phone, incoming_msg, patient_name_for_save)
+        resp.message("🔎 Analyzing your symptoms — I'll reply shortly.")
+        return str(resp)
     else:
-        # Get diagnosis from LLM
-        diagnosis_name, diagnosis_response = diagnose(incoming_msg)
-        response_text = f"AI Doctor Report:\n\nSymptoms: {incoming_msg}\nDiagnosis: {diagnosis_response}"
-
-    # Determine patient_name (you might want to add a way for users to set this)
-    patient_name_for_save = "Unknown"
+        # Without a Twilio client the report can only be returned in this response
+        diagnosis_name, diagnosis_response = await diagnose(incoming_msg)
+        response_text = format_report(incoming_msg, diagnosis_name, diagnosis_response)
 
     # Save to database and send response
-    if save_to_db(phone, incoming_msg, diagnosis_name, response_text, patient_name_for_save):
+    if save_to_db(phone, incoming_msg, diagnosis_name, diagnosis_response, patient_name_for_save):
         resp.message(response_text)
     else:
         resp.message("⚠️ System error - your symptoms were not saved. Please try again.")
@@ -220,4 +607,5 @@ if __name__ == "__main__":
 /____/_/_/_/_/____/\__/_/   |_/____/\___/ 
                                             
 AI Doctor System Ready!""")
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Local development only; production runs under hypercorn (see Procfile)
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file